@@ -7,8 +7,10 @@ setup(
     install_requires=[
         'python-telegram-bot==21.9',  # Actualizado a la versión más reciente
         'openai',
+        'httpx[http2]',
         'Flask',
         'python-dotenv',
+        'aiofiles',
         # Add other dependencies here
     ],
     entry_points={
@@ -1,9 +1,46 @@
-import time
 import asyncio
+import logging
 import re
 import os
 import base64
-from typing import Optional, Dict, Callable, Any
+from collections import deque
+from typing import Optional, Dict, Set, Callable, Any
+import aiofiles
+from openai import AsyncAssistantEventHandler
+
+from .config import telegram_flush_delay_secs
+
+logger = logging.getLogger(__name__)
+
+# Número máximo de mensajes que se conservan en el historial de cada handler
+MAX_HISTORY_MESSAGES = 20
+
+# Telegram corta los mensajes en 4096 caracteres; dejamos margen para el formato HTML
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+# Patrones precompilados para el formateo de texto en el streaming
+_RE_PARA_SPLIT = re.compile(r'\n\n+')
+# Espacios antes de dos puntos (se eliminan) o espacios repetidos (se colapsan)
+_RE_MD_SPACES = re.compile(r'(\s+(?=:))| {2,}')
+# Elementos numerados en negrita, elementos numerados, encabezados ### y **negrita**
+_RE_MD_FORMAT = re.compile(
+    r'(\d+)\.\s+\*\*\s*([^*]+?)\s*\*\*\s*:'
+    r'|(\d+)\.\s+([^:\n]+):'
+    r'|###\s+([^#\n]+)'
+    r'|\*\*([^*]+)\*\*'
+)
+
+
+def _format_markdown_match(match):
+    """Devuelve el reemplazo en formato Telegram para una coincidencia de _RE_MD_FORMAT."""
+    num_bold, bold_text, num, item_text, header, bold = match.groups()
+    if num_bold:
+        return f"{num_bold}. *{bold_text}*:"
+    if num:
+        return f"{num}. *{item_text}*:"
+    if header:
+        return f"*{header}*"
+    return f"*{bold}*"
 
 
 def clean_text_and_split(text):
@@ -11,26 +48,11 @@ def clean_text_and_split(text):
     Divide el texto en párrafos formateados preservando los espacios originales.
     Respeta markdown y formatos de Telegram como **negrita**.
     """
-    # Pre-procesamiento para asegurar que ciertos patrones se preservan intactos
-    
-    # Conservar intactos los patrones de títulos con 📌
-    processed_parts = []
-    parts = re.split(r'(📌\s+[^:]+\s*:)', text)
-    for i, part in enumerate(parts):
-        if i % 2 == 1:  # Es un título con 📌
-            processed_parts.append(part)
-        else:
-            processed_parts.append(part)
-    
-    text = ''.join(processed_parts)
-    
     # Dividir el texto por saltos de línea que sean significativos
-    paragraphs = re.split(r'\n\n+', text)
+    paragraphs = _RE_PARA_SPLIT.split(text)
     
     # Filtrar párrafos vacíos
-    paragraphs = [p for p in paragraphs if p.strip()]
-    
-    return paragraphs
+    return [p for p in paragraphs if p.strip()]
 
 
 def process_markdown(text):
@@ -38,24 +60,11 @@ def process_markdown(text):
     Procesa el texto para asegurar que el formato markdown de Telegram es correcto.
     Maneja cuidadosamente el formato para evitar problemas con asteriscos y espacios.
     """
-    # Corregir múltiples espacios en todo el texto
-    text = re.sub(r' +', ' ', text)
-    
-    # Eliminar espacios antes de los dos puntos
-    text = re.sub(r'\s+:', r':', text)
-    
-    # Corregir el patrón problemático: "1. **  Texto  **:" -> "1. *Texto*:"
-    text = re.sub(r'(\d+)\.\s+\*\*\s+([^*]+)\s+\*\*\s*:', r'\1. *\2*:', text)
+    # Corregir espacios repetidos y eliminar los que preceden a los dos puntos
+    text = _RE_MD_SPACES.sub(lambda m: '' if m.group(1) else ' ', text)
     
-    # Corregir el formato de encabezados
-    text = re.sub(r'###\s+([^#\n]+)', r'*\1*', text)
-    
-    # Corregir el formato de elementos numerados
-    text = re.sub(r'(\d+)\.\s+([^:]+):', r'\1. *\2*:', text)
-    
-    # Asegurarse de que los asteriscos para negrita estén correctamente formateados
-    # Convertir **texto** a *texto* para Telegram (uno solo para negrita)
-    text = re.sub(r'\*\*([^*]+)\*\*', r'*\1*', text)
+    # Elementos numerados, encabezados y **texto** -> *texto* (negrita de Telegram) en una sola pasada
+    text = _RE_MD_FORMAT.sub(_format_markdown_match, text)
     
     # Eliminar cualquier asterisco duplicado que pueda quedar
     text = text.replace('**', '*').replace('* *', '*')
@@ -63,187 +72,190 @@ def process_markdown(text):
     return text
 
 
+def _group_paragraphs(paragraphs, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Une los párrafos en el mínimo de mensajes sin superar el límite de caracteres de Telegram."""
+    messages = []
+    current = ""
+    for paragraph in paragraphs:
+        # Un párrafo más largo que el límite se corta en trozos
+        while len(paragraph) > limit:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(paragraph[:limit])
+            paragraph = paragraph[limit:]
+
+        if current and len(current) + 2 + len(paragraph) > limit:
+            messages.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def _send_paragraphs(pending, send_to_telegram):
+    """Envía todos los párrafos pendientes agrupados y vacía la lista."""
+    batch = pending[:]
+    pending.clear()
+    for message in _group_paragraphs(batch):
+        await send_to_telegram(message)
+
+
+async def _flush_paragraphs_later(pending, send_to_telegram):
+    """Espera unos instantes para acumular párrafos y los envía en lotes hasta vaciar la lista."""
+    while pending:
+        await asyncio.sleep(telegram_flush_delay_secs)
+        await _send_paragraphs(pending, send_to_telegram)
+
+
+class _QueuedNotifier(AsyncAssistantEventHandler):
+    """Avisa una sola vez al usuario cuando el run queda en cola."""
+
+    def __init__(self, send_to_telegram):
+        super().__init__()
+        self._send_to_telegram = send_to_telegram
+        self._queued_notified = False
+
+    async def on_event(self, event) -> None:
+        if event.event == "thread.run.queued" and not self._queued_notified:
+            self._queued_notified = True
+            await self._send_to_telegram("🔄 Tu solicitud está en cola. Esto puede tardar un momento debido a alta demanda...")
+
+
 class AssistantHandler:
     def __init__(self, client, assistant_id):
         self.client = client
         self.assistant_id = assistant_id
         self.thread_id = None
-        self.message_history = []
+        self.message_history = deque(maxlen=MAX_HISTORY_MESSAGES)  # Solo se conservan los últimos mensajes
         self.threads: Dict[int, str] = {}  # Almacenar {group_id: thread_id} en memoria
-        self._in_progress_runs: Dict[str, bool] = {}  # Seguimiento de runs en progreso por thread_id
+        self._active_runs: Set[str] = set()  # thread_ids con un run en curso, para no solaparlos
+        self._model_name: Optional[str] = None  # Modelo del asistente, se consulta una sola vez
+
+    async def _get_model_name(self) -> str:
+        """Obtiene el modelo del asistente, consultándolo a OpenAI solo la primera vez."""
+        if self._model_name is None:
+            try:
+                assistant_info = await self.client.beta.assistants.retrieve(self.assistant_id)
+                self._model_name = getattr(assistant_info, 'model', 'desconocido')
+                logger.debug("Modelo del asistente: %s", self._model_name)
+            except Exception as e:
+                self._model_name = "desconocido"
+                logger.debug("No se pudo obtener información del modelo: %s", e)
+        return self._model_name
 
     async def stream_response(self, group_id: int, message_str: str, send_to_telegram):
         """Envía un mensaje al asistente y transmite la respuesta al usuario."""
         thread_id = self.threads.get(group_id)
 
         if not thread_id:
-            print(f"[DEBUG] No se encontró un thread_id para group_id: {group_id}, no se creará aquí")
+            logger.debug("No se encontró un thread_id para group_id: %s, no se creará aquí", group_id)
             return
 
-        print(f"[DEBUG] Usando thread_id: {thread_id} para group_id: {group_id}")
+        logger.debug("Usando thread_id: %s para group_id: %s", thread_id, group_id)
 
         # Verificar si ya hay un run en progreso para este thread
-        if self._in_progress_runs.get(thread_id, False):
-            print(f"[WARN] Ya hay un run en progreso para thread_id: {thread_id}")
+        if thread_id in self._active_runs:
+            logger.warning("Ya hay un run en progreso para thread_id: %s", thread_id)
             await send_to_telegram("⏳ Estoy procesando una solicitud anterior. Por favor, espera un momento.")
             return
 
+        self._active_runs.add(thread_id)
         try:
-            # Marcar este thread como en progreso
-            self._in_progress_runs[thread_id] = True
-            
             # Enviar el mensaje al asistente
             try:
-                self.client.beta.threads.messages.create(
+                await self.client.beta.threads.messages.create(
                     thread_id=thread_id,
                     role="user",
                     content=message_str
                 )
                 self.message_history.append({"role": "user", "content": message_str})
             except Exception as e:
-                print(f"[ERROR] Error enviando mensaje al asistente: {e}")
-                self._in_progress_runs[thread_id] = False
+                logger.error("Error enviando mensaje al asistente: %s", e)
                 return
 
             try:
-                with self.client.beta.threads.runs.create_and_stream(
-                    thread_id=thread_id,
-                    assistant_id=self.assistant_id,
-                ) as event_handler:
-                    buffer = ""
-                    accumulated_text = ""
-                    
-                    for partial_text in event_handler.text_deltas:
-                        buffer += partial_text
-                        
-                        # Cuando detectamos un doble salto de línea, enviamos el párrafo
-                        if '\n\n' in buffer:
-                            parts = buffer.split('\n\n', 1)
-                            accumulated_text += parts[0]
-                            
-                            # Simplemente enviamos el texto sin procesar markdown
-                            processed_text = accumulated_text.strip()
-                            
-                            if processed_text:
-                                await send_to_telegram(processed_text)
-                                self.message_history.append({"role": "assistant", "content": processed_text})
-                            
-                            buffer = parts[1]
-                            accumulated_text = ""
-                    
-                    # Enviar cualquier texto restante en el buffer
-                    if buffer.strip():
-                        processed_text = buffer.strip()
-                        await send_to_telegram(processed_text)
-                        self.message_history.append({"role": "assistant", "content": processed_text})
-                        
+                await self._stream_run(thread_id, send_to_telegram)
             except Exception as e:
-                print(f"[ERROR] Error durante el streaming: {e}")
+                logger.error("Error durante el streaming: %s", e)
         finally:
-            # Asegurarse de que el thread se marque como no en progreso, incluso si hay error
-            self._in_progress_runs[thread_id] = False
+            self._active_runs.discard(thread_id)
 
     async def stream_image_response(self, group_id: int, message_str: str, image_base64: str, image_path: str, send_to_telegram):
-        """Método utilizando Files API con timeout y manejo mejorado de queued"""
+        """Método utilizando Files API y streaming del run, con aviso cuando queda en cola"""
         thread_id = self.threads.get(group_id)
 
         if not thread_id:
-            print(f"[DEBUG] No se encontró un thread_id para group_id: {group_id}, no se creará aquí")
+            logger.debug("No se encontró un thread_id para group_id: %s, no se creará aquí", group_id)
             return
 
-        print(f"[DEBUG] Usando thread_id: {thread_id} para group_id: {group_id} con imagen")
+        logger.debug("Usando thread_id: %s para group_id: %s con imagen", thread_id, group_id)
 
         # Verificar si ya hay un run en progreso para este thread
-        if self._in_progress_runs.get(thread_id, False):
-            print(f"[WARN] Ya hay un run en progreso para thread_id: {thread_id}")
+        if thread_id in self._active_runs:
+            logger.warning("Ya hay un run en progreso para thread_id: %s", thread_id)
             await send_to_telegram("⏳ Estoy procesando una solicitud anterior. Por favor, espera un momento.")
             return
 
+        self._active_runs.add(thread_id)
         try:
-            # Marcar este thread como en progreso
-            self._in_progress_runs[thread_id] = True
-            
             # Primero creamos un mensaje informativo para el usuario
             await send_to_telegram("🔍 Estoy analizando la imagen. Esto puede tardar unos momentos...")
 
-            # Guardar información del modelo que usa el asistente para diagnóstico
+            # Información del modelo que usa el asistente para diagnóstico
+            model_name = await self._get_model_name()
+
+            # Subir la imagen a OpenAI para obtener el file_id
             try:
-                assistant_info = self.client.beta.assistants.retrieve(self.assistant_id)
-                model_name = getattr(assistant_info, 'model', 'desconocido')
-                print(f"[DEBUG] Modelo del asistente: {model_name}")
+                logger.debug("Subiendo imagen a OpenAI Files API...")
+                
+                # Lectura asíncrona para no bloquear el event loop
+                async with aiofiles.open(image_path, 'rb') as f:
+                    image_bytes = await f.read()
+                file_upload = await self.client.files.create(
+                    file=(os.path.basename(image_path), image_bytes),
+                    purpose="assistants"
+                )
+                
+                file_id = file_upload.id
+                logger.debug("Archivo subido exitosamente, ID: %s", file_id)
             except Exception as e:
-                model_name = "desconocido"
-                print(f"[DEBUG] No se pudo obtener información del modelo: {e}")
+                logger.error("Error subiendo archivo a OpenAI: %s", e)
+                await send_to_telegram(f"⚠️ No se pudo subir la imagen. Error: {str(e)}")
+                return
 
-            # Intentar subir el archivo a OpenAI para obtener el file_id
+            # Enviar el texto y la imagen en un único mensaje del usuario
+            text_part = {"type": "text", "text": message_str}
             try:
-                print(f"[DEBUG] Subiendo imagen a OpenAI Files API...")
-                
-                # Crear el mensaje del usuario con el texto
-                self.client.beta.threads.messages.create(
+                await self.client.beta.threads.messages.create(
                     thread_id=thread_id,
                     role="user",
-                    content=message_str
+                    content=[text_part, {"type": "image_file", "image_file": {"file_id": file_id}}]
                 )
-                print("[DEBUG] Mensaje de texto enviado correctamente")
-                
-                # Subir la imagen
-                with open(image_path, 'rb') as f:
-                    file_upload = self.client.files.create(
-                        file=f,
-                        purpose="assistants"
-                    )
-                
-                file_id = file_upload.id
-                print(f"[DEBUG] Archivo subido exitosamente, ID: {file_id}")
-                
-                # Intentar con el formato image_file directamente (el que funcionó antes)
+                logger.debug("Mensaje con imagen enviado correctamente")
+            except Exception as e:
+                logger.error("Error enviando mensaje con image_file: %s", e)
+                # Intentar con formato alternativo como último recurso
                 try:
-                    self.client.beta.threads.messages.create(
+                    logger.debug("Intentando formato alternativo...")
+                    # Reutilizar los bytes ya leídos para la subida
+                    b64_image = base64.b64encode(image_bytes).decode()
+                    
+                    await self.client.beta.threads.messages.create(
                         thread_id=thread_id,
                         role="user",
                         content=[
-                            {
-                                "type": "image_file",
-                                "image_file": {
-                                    "file_id": file_id
-                                }
-                            }
+                            text_part,
+                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_image}"}}
                         ]
                     )
-                    print("[DEBUG] Mensaje con imagen enviado correctamente")
-                except Exception as e:
-                    print(f"[ERROR] Error enviando mensaje con image_file: {e}")
-                    # Intentar con formato alternativo como último recurso
-                    try:
-                        print("[DEBUG] Intentando formato alternativo...")
-                        with open(image_path, "rb") as img_file:
-                            b64_image = base64.b64encode(img_file.read()).decode()
-                        
-                        self.client.beta.threads.messages.create(
-                            thread_id=thread_id,
-                            role="user",
-                            content=[
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{b64_image}"
-                                    }
-                                }
-                            ]
-                        )
-                        print("[DEBUG] Formato alternativo tuvo éxito")
-                    except Exception as e2:
-                        print(f"[ERROR] Error con el formato alternativo: {e2}")
-                        await send_to_telegram("❌ No pude procesar la imagen. Por favor, intenta con otra imagen o consulta sin imagen.")
-                        self._in_progress_runs[thread_id] = False
-                        return
-                
-            except Exception as e:
-                print(f"[ERROR] Error subiendo archivo a OpenAI: {e}")
-                await send_to_telegram(f"⚠️ No se pudo subir la imagen. Error: {str(e)}")
-                self._in_progress_runs[thread_id] = False
-                return
+                    logger.debug("Formato alternativo tuvo éxito")
+                except Exception as e2:
+                    logger.error("Error con el formato alternativo: %s", e2)
+                    await send_to_telegram("❌ No pude procesar la imagen. Por favor, intenta con otra imagen o consulta sin imagen.")
+                    return
 
             # Registramos en el historial
             self.message_history.append({
@@ -251,105 +263,86 @@ class AssistantHandler:
                 "content": f"{message_str} [IMAGEN adjuntada como archivo: {file_id}]"
             })
 
-            # Ejecutar el asistente para procesar el mensaje y la imagen
+            # Ejecutar el asistente en streaming para procesar el mensaje y la imagen
             try:
-                print("[DEBUG] Iniciando análisis de la imagen...")
-                
-                # Crear un run para el thread
-                run = self.client.beta.threads.runs.create(
-                    thread_id=thread_id,
-                    assistant_id=self.assistant_id
-                )
-                
-                # Esperar a que termine la ejecución
-                run_status = run.status
-                run_id = run.id
-                
-                # Variables para controlar el timeout
-                max_wait_time = 120  # Segundos máximos de espera (2 minutos)
-                start_time = time.time()
-                queued_message_sent = False
-                queued_time_start = None
-                
-                while run_status not in ["completed", "failed", "cancelled", "expired"]:
-                    elapsed_time = time.time() - start_time
-                    print(f"[DEBUG] Estado actual del run: {run_status}, tiempo transcurrido: {elapsed_time:.1f}s")
-                    
-                    # Manejar el estado "queued" específicamente
-                    if run_status == "queued":
-                        if not queued_message_sent:
-                            await send_to_telegram("🔄 Tu solicitud está en cola. Esto puede tardar un momento debido a alta demanda...")
-                            queued_message_sent = True
-                            queued_time_start = time.time()
-                        
-                        # Si ha estado en cola por más de 30 segundos, informar al usuario
-                        if queued_time_start and (time.time() - queued_time_start > 30):
-                            await send_to_telegram("⏳ Tu solicitud sigue en cola. A veces el procesamiento de imágenes puede tardar un poco más. Gracias por tu paciencia.")
-                            # Reset para no enviar este mensaje de nuevo
-                            queued_time_start = None
-                    
-                    # Verificar si excedimos el tiempo máximo de espera
-                    if elapsed_time > max_wait_time:
-                        print(f"[WARN] Excedido tiempo máximo de espera ({max_wait_time}s)")
-                        await send_to_telegram("⚠️ El análisis está tomando más tiempo del esperado. Puedo continuar esperando o puedes cancelar e intentarlo nuevamente. ¿Quieres continuar esperando?")
-                        
-                        # Extender el tiempo de espera
-                        max_wait_time += 60  # Añadir un minuto más
-                    
-                    # Esperar un poco antes de verificar de nuevo (con backoff exponencial)
-                    base_wait = min(5, 1 + (elapsed_time / 20))  # Incrementar el tiempo de espera gradualmente
-                    await asyncio.sleep(base_wait)
-                    
-                    # Obtener estado actualizado
-                    try:
-                        run = self.client.beta.threads.runs.retrieve(
-                            thread_id=thread_id,
-                            run_id=run_id
-                        )
-                        run_status = run.status
-                    except Exception as e:
-                        print(f"[ERROR] Error al obtener estado del run: {e}")
-                        # Si hay error al obtener estado, incrementar el tiempo de espera
-                        await asyncio.sleep(5)
-                
-                # Informar sobre estado final
-                print(f"[DEBUG] Run completado con estado: {run_status}, tiempo total: {time.time() - start_time:.1f}s")
-                
-                if run_status == "completed":
-                    # Obtener los mensajes de respuesta
-                    messages = self.client.beta.threads.messages.list(
-                        thread_id=thread_id
-                    )
-                    
-                    # Extraer el último mensaje del asistente
-                    assistant_messages = []
-                    for msg in messages.data:
-                        if msg.role == "assistant" and msg.run_id == run_id:
-                            # Extraer el contenido del mensaje
-                            for content_item in msg.content:
-                                if content_item.type == "text":
-                                    assistant_messages.append(content_item.text.value)
-                    
-                    # Enviar las respuestas del asistente
-                    if assistant_messages:
-                        for msg_text in assistant_messages:
-                            # Sin procesar markdown, simplemente enviar el texto tal cual
-                            await send_to_telegram(msg_text)
-                            self.message_history.append({"role": "assistant", "content": msg_text})
-                    else:
-                        await send_to_telegram(f"⚠️ El asistente no generó una respuesta para la imagen. Modelo usado: {model_name}")
-                else:
+                logger.debug("Iniciando análisis de la imagen...")
+                run_status, paragraphs = await self._stream_run(thread_id, send_to_telegram, notify_queued=True)
+                logger.debug("Run completado con estado: %s", run_status)
+
+                if run_status != "completed":
                     await send_to_telegram(f"❌ El análisis falló con estado: {run_status}. Modelo usado: {model_name}")
+                elif not paragraphs:
+                    await send_to_telegram(f"⚠️ El asistente no generó una respuesta para la imagen. Modelo usado: {model_name}")
                     
             except Exception as e:
-                print(f"[ERROR] Error durante el análisis de la imagen: {e}")
+                logger.error("Error durante el análisis de la imagen: %s", e)
                 await send_to_telegram(f"Lo siento, ocurrió un error al analizar la imagen: {str(e)}")
         finally:
-            # Asegurarse de que el thread se marque como no en progreso, incluso si hay error
-            self._in_progress_runs[thread_id] = False
-
-    def trim_message_history(self):
-        """Mantiene el historial de mensajes limitado a los últimos 20 mensajes."""
-        max_messages = 20
-        if len(self.message_history) > max_messages:
-            self.message_history = self.message_history[-max_messages:]
\ No newline at end of file
+            self._active_runs.discard(thread_id)
+
+    async def _stream_run(self, thread_id: str, send_to_telegram, notify_queued: bool = False):
+        """
+        Lanza un run en streaming sobre el thread y envía la respuesta al usuario.
+        Los párrafos que llegan seguidos se agrupan durante un breve intervalo y se
+        envían juntos para reducir las llamadas a Telegram.
+        Devuelve el estado final del run y la lista de párrafos generados.
+        """
+        event_handler = _QueuedNotifier(send_to_telegram) if notify_queued else None
+        paragraphs = []
+        pending = []  # Párrafos listos que aún no se han enviado a Telegram
+        flush_task: Optional[asyncio.Task] = None
+
+        def add_paragraph(text):
+            pending.append(text)
+            paragraphs.append(text)
+
+        try:
+            async with self.client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=self.assistant_id,
+                event_handler=event_handler,
+            ) as stream:
+                chunks = []  # Fragmentos del párrafo en curso; se unen solo al detectar un separador
+            
+                async for partial_text in stream.text_deltas:
+                    if not partial_text:
+                        continue
+
+                    # El doble salto de línea puede llegar partido entre el fragmento anterior y el nuevo
+                    split_separator = bool(chunks) and chunks[-1].endswith('\n') and partial_text.startswith('\n')
+                    chunks.append(partial_text)
+                    if not split_separator and '\n\n' not in partial_text:
+                        continue
+
+                    # Cuando detectamos un doble salto de línea, los párrafos completos quedan listos para enviarse
+                    *ready, rest = ''.join(chunks).split('\n\n')
+                    chunks = [rest] if rest else []
+
+                    for paragraph in ready:
+                        # Simplemente enviamos el texto sin procesar markdown
+                        processed_text = paragraph.strip()
+                        if processed_text:
+                            add_paragraph(processed_text)
+                            if flush_task is None or flush_task.done():
+                                flush_task = asyncio.create_task(_flush_paragraphs_later(pending, send_to_telegram))
+            
+                # Añadir cualquier texto restante
+                processed_text = ''.join(chunks).strip()
+                if processed_text:
+                    add_paragraph(processed_text)
+
+                run_status = stream.current_run.status if stream.current_run else None
+        finally:
+            # No devolver el control (ni dar el thread por libre) hasta que Telegram haya
+            # recibido todo lo generado, también si el streaming falla a mitad
+            if flush_task is not None:
+                flush_result, = await asyncio.gather(flush_task, return_exceptions=True)
+                if isinstance(flush_result, Exception):
+                    logger.error("Error enviando párrafos a Telegram: %s", flush_result)
+            await _send_paragraphs(pending, send_to_telegram)
+
+        # Una sola entrada de historial por respuesta del asistente
+        if paragraphs:
+            self.message_history.append({"role": "assistant", "content": "\n\n".join(paragraphs)})
+
+        return run_status, paragraphs
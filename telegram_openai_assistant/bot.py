@@ -1,7 +1,9 @@
 import asyncio
+import logging
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, PicklePersistence
 from telegram import Update
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 from .conversation_manager import ConversationManager
 from .assistant_handler import AssistantHandler
@@ -11,13 +13,16 @@ from .handlers import BotHandlers
 from .config import client_api_key
 
 import threading
-import subprocess
+import inspect
+import runpy
+import signal
 import os
 
 def start_keep_alive():
-    """Ejecuta keep_alive.py en segundo plano"""
+    """Arranca el servidor de keep_alive.py en un hilo de este mismo proceso"""
     try:
-        subprocess.Popen(["python", "keep_alive.py"])
+        # Al ejecutarse, keep_alive.py arranca Flask en un hilo daemon
+        runpy.run_path("keep_alive.py", run_name="keep_alive")
         print("Keep-alive ejecutado correctamente")
     except Exception as e:
         print(f"No se pudo iniciar keep_alive: {e}")
@@ -30,7 +35,32 @@ except Exception as e:
     print(f"No se pudo iniciar keep_alive: {e}")
 
 
-client = OpenAI(api_key=client_api_key)
+# Detectar una sola vez qué parámetros admite PicklePersistence en la versión instalada
+_PP_HAS_JSON = 'chat_data_json' in inspect.signature(PicklePersistence).parameters
+
+
+def _make_persistence(path: str, bot_name: str):
+    """Crea la persistencia del bot o devuelve None si no es posible."""
+    kwargs = {'filepath': path}
+    if _PP_HAS_JSON:
+        kwargs.update(chat_data_json=True, user_data_json=True)
+    else:
+        print(f"Usando PicklePersistence básico para {bot_name}")
+    try:
+        return PicklePersistence(**kwargs)
+    except Exception as e:
+        print(f"Error al crear persistencia, continuando sin ella: {e}")
+        return None
+
+
+# Un único pool HTTP compartido por todos los bots: reutiliza conexiones TCP/TLS
+# y multiplexa las peticiones concurrentes a OpenAI sobre HTTP/2
+http_client = DefaultAsyncHttpxClient(
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    http2=True,
+)
+client = AsyncOpenAI(api_key=client_api_key, http_client=http_client)
 
 
 
@@ -49,24 +79,7 @@ class Bot:
         persistence_path = os.path.join(persistence_directory, "bot_data.pickle")
         
         # Crear el objeto de persistencia - compatible con python-telegram-bot 21.x
-        # Verificar versión y ajustar parámetros
-        try:
-            # Intentar con la API más reciente
-            persistence = PicklePersistence(
-                filepath=persistence_path,
-                chat_data_json=True,  # En lugar de store_chat_data
-                user_data_json=True   # Guardar también datos de usuario
-            )
-        except TypeError:
-            try:
-                # Intentar con la API alternativa
-                persistence = PicklePersistence(
-                    filepath=persistence_path
-                )
-                print(f"Usando PicklePersistence básico para {bot_name}")
-            except Exception as e:
-                print(f"Error al crear persistencia, continuando sin ella: {e}")
-                persistence = None
+        persistence = _make_persistence(persistence_path, bot_name)
         
         self.handlers = BotHandlers(bot_name, assistant_id, token, manager)
         
@@ -117,14 +130,22 @@ async def start_bots(manager: ConversationManager):
     names = ["Regen", "Degen"]
     bots = {}
     
+    async def build_bot(name: str, token: str, assistant_id: str) -> "Bot":
+        print(f"Creando bot {name}...")
+        # La construcción (persistencia + ApplicationBuilder) se hace en un hilo para crear los bots en paralelo
+        return await asyncio.to_thread(Bot, name, token, assistant_id, manager)
+
     # Intentar crear cada bot
-    for name, token, assistant_id in zip(names, telegram_token_bots, assistant_id_bots):
-        try:
-            print(f"Creando bot {name}...")
-            bot = Bot(name, token, assistant_id, manager)
-            bots[name] = bot
-        except Exception as e:
-            print(f"Error al crear bot {name}: {e}")
+    bot_configs = list(zip(names, telegram_token_bots, assistant_id_bots))
+    results = await asyncio.gather(
+        *(build_bot(name, token, assistant_id) for name, token, assistant_id in bot_configs),
+        return_exceptions=True,
+    )
+    for (name, _, _), result in zip(bot_configs, results):
+        if isinstance(result, Exception):
+            print(f"Error al crear bot {name}: {result}")
+        else:
+            bots[name] = result
     
     if not bots:
         print("No se pudo crear ningún bot. Saliendo.")
@@ -136,11 +157,26 @@ async def start_bots(manager: ConversationManager):
     print("Iniciando todos los bots...")
     await asyncio.gather(*(bot.start() for bot in bots.values()))
 
+    # Esperar a SIGINT/SIGTERM sin despertar el event loop periódicamente
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        use_signal_handlers = True
+    except NotImplementedError:
+        # Windows no soporta add_signal_handler; Ctrl+C llega como KeyboardInterrupt
+        use_signal_handlers = False
+
     try:
         # Keep the event loop running until interrupted
         print("Bots en funcionamiento. Presiona Ctrl+C para detener.")
-        while True:
-            await asyncio.sleep(1)
+        if use_signal_handlers:
+            await stop_event.wait()
+            print("Bots apagándose...")
+        else:
+            while True:
+                await asyncio.sleep(1)
     except KeyboardInterrupt:
         print("Bots apagándose...")
     except Exception as e:
@@ -159,9 +195,20 @@ async def start_bots(manager: ConversationManager):
         shutdown_tasks = [bot.application.shutdown() for bot in bots.values()]
         await asyncio.gather(*shutdown_tasks)
 
+        # Cerrar el pool HTTP compartido con OpenAI
+        await client.close()
+
 
 def main():
     """Main function to run the bots."""
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    )
+    # httpx/httpcore registran cada petición en INFO con la URL completa, que incluye el token
+    # del bot; werkzeug (keep_alive) registra cada petición HTTP entrante
+    for noisy_logger in ("httpx", "httpcore", "werkzeug"):
+        logging.getLogger(noisy_logger).setLevel(logging.WARNING)
     print("Iniciando bots de telegram...")
     
     # Asegurar carpetas necesarias
@@ -13,6 +13,13 @@ assistant_id_bots = os.getenv("ASSISTANT_ID_BOT", "").split(",")
 
 client_api_key = os.getenv("CLIENT_API_KEY")
 
+# Seconds to wait while grouping streamed paragraphs into a single Telegram message
+telegram_flush_delay_secs = float(os.getenv("TG_FLUSH_DELAY_SECS", "0.4"))
+
+# Maximum number of group_id -> thread_id entries kept in memory (0 = unlimited).
+# Evicted chats start a new OpenAI thread, so keep this well above the number of active chats.
+thread_cache_max = int(os.getenv("THREAD_CACHE_MAX", "50000"))
+
 # Optional: Clean up whitespace from each item in the lists
 telegram_token_bots = [token.strip() for token in telegram_token_bots if token.strip()]
 assistant_id_bots = [aid.strip() for aid in assistant_id_bots if aid.strip()]
@@ -1,35 +1,143 @@
 import time
 import asyncio
+import functools
+import logging
 import re
 import os
+from collections import OrderedDict
 from typing import Optional, Dict
 from telegram.constants import ParseMode
-import threading
 
-# Semáforo global para la creación de threads
-thread_creation_lock = threading.Lock()
+from .config import thread_cache_max
+
+logger = logging.getLogger(__name__)
+
+# Patrones precompilados para el formateo HTML y el procesado de mensajes
+_RE_H3 = re.compile(r'###\s+')
+# Marcadores ### (con los espacios que los rodean) o espacios antes de dos puntos
+_RE_H3_OR_COLON = re.compile(r'(?:\s*###\s+)+:?|\s+:')
+_RE_BOLD_SP = re.compile(r'\*\*\s+([^*]+)\s+\*\*')
+_RE_BOLD = re.compile(r'\*\*([^*]+)\*\*')
+_RE_NUMBERED = re.compile(r'(\d+)\.\s+<b>([^<]+)</b>:')
+_RE_ESCAPED_TAG = re.compile(r'&lt;(/?[bi])&gt;')
+# Subcadenas sin las que ningún patrón de prepare_text_for_html puede coincidir
+_HTML_FORMAT_TRIGGERS = ('###', ':', '**', '•', '-', '&lt;')
+# Etiqueta con el nombre del usuario que antes se anteponía al mensaje; se sigue aceptando
+_USER_INFO_PREFIX = '[INFORMACIÓN DEL USUARIO: Nombre='
+# Número máximo de grupos con datos de usuario y conversación en memoria
+MAX_CACHED_GROUPS = 10_000
+# Saludos con los que se personaliza la respuesta; 16 caracteres bastan para el más largo
+_GREETING_PREFIXES = ('hola', 'buenos días', 'buenas tardes', 'buenas noches')
+
+
+def _strip_header_or_colon(match):
+    """
+    Reemplazo para _RE_H3_OR_COLON: si el tramo acaba en dos puntos se conservan solo
+    los dos puntos; si no, se eliminan los marcadores ### y se respeta el resto del espaciado.
+    """
+    matched = match.group()
+    if matched.endswith(':'):
+        return ':'
+    return _RE_H3.sub('', matched)
+
+
+def _normalize_bullets(text: str) -> str:
+    """
+    Normaliza las viñetas en una sola pasada: '•' seguido de espacios queda como '• ' y
+    un guion al inicio de línea seguido de espacios se convierte en '\n• '.
+    """
+    out = []
+    n = len(text)
+    start = i = 0
+    while i < n:
+        ch = text[i]
+        if ch == '•':
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j > i + 1:
+                out.append(text[start:i])
+                out.append('• ')
+                start = j
+            i = j
+        elif ch == '\n':
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j < n and text[j] == '-':
+                k = j + 1
+                while k < n and text[k].isspace():
+                    k += 1
+                if k > j + 1:
+                    out.append(text[start:i])
+                    out.append('\n• ')
+                    start = i = k
+                    continue
+            # Ningún salto de línea dentro de este tramo de espacios puede coincidir
+            i = j
+        else:
+            i += 1
+    if not out:
+        return text
+    out.append(text[start:])
+    return ''.join(out)
+
+class _LRUDict(OrderedDict):
+    """
+    Diccionario con tamaño máximo: al leer o escribir una clave pasa a ser la más reciente
+    y, al superar maxsize, se descarta la menos usada. maxsize=0 desactiva el límite.
+    """
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return super().__getitem__(key)
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize and len(self) > self.maxsize:
+            self.popitem(last=False)
+
 
 class ConversationManager:
     """Manages global state and orchestrates bot-to-bot conversations."""
+    __slots__ = ('all_bots', 'active_conversation', 'threads', 'user_data', '_thread_creation',
+                 '_first_bot_name', '_first_bot')
+
     def __init__(self):
         self.all_bots: Dict[str, 'Bot'] = {}  # Dictionary to hold all bots by name
-        self.active_conversation: Dict[int, dict] = {}  # {group_id: conversation_state}
-        self.bot_order: list[str] = []  # List of bot names in fixed order
-        self.current_bot_index: int = 0  # Tracks the current bot in the rotation
-        self.last_assistant_response = None
-        self.threads: Dict[int, str] = {}  # {group_id: thread_id} almacena los hilos en memoria
-        self.user_data: Dict[int, Dict[str, str]] = {}  # Almacena información de usuarios {group_id: {name: nombre, ...}}
-        self._thread_locks: Dict[int, asyncio.Lock] = {}  # Locks para cada group_id
+        self.active_conversation: Dict[int, str] = _LRUDict(MAX_CACHED_GROUPS)  # {group_id: bot_name} que inició la conversación
+        self.threads: Dict[int, str] = _LRUDict(thread_cache_max)  # {group_id: thread_id} almacena los hilos en memoria
+        self.user_data: Dict[int, Dict[str, str]] = _LRUDict(MAX_CACHED_GROUPS)  # Almacena información de usuarios {group_id: {name: nombre, ...}}
+        self._thread_creation: Dict[int, asyncio.Future] = {}  # {group_id: future} de los threads que se están creando
+        self._first_bot_name: Optional[str] = None  # Bot que responde, fijado en register_bots
+        self._first_bot: Optional['Bot'] = None
     
     def register_bots(self, bots: Dict[str, 'Bot']):
         """Registra los bots disponibles en la instancia de ConversationManager."""
         self.all_bots = bots
-        print("[DEBUG] Bots registrados correctamente.")
+        self._first_bot_name = next(iter(bots), None)
+        self._first_bot = bots.get(self._first_bot_name)
+        logger.debug("Bots registrados correctamente.")
         
-        # Sincronizar threads hacia los handlers
+        # Todos los handlers comparten el mismo diccionario de threads: cualquier alta o baja
+        # en self.threads es visible al instante para cada bot sin sincronizar uno a uno
         for bot_name, bot in self.all_bots.items():
             bot.assistant_handler.threads = self.threads
 
+    def start_conversation(self, group_id: int, bot_name: str) -> bool:
+        """Marca la conversación del grupo como iniciada por bot_name. Devuelve True si es nueva."""
+        if group_id in self.active_conversation:
+            return False
+        self.active_conversation[group_id] = bot_name
+        return True
+
     def is_active(self, group_id: int) -> bool:
         """Verifica si un group_id tiene una conversación activa."""
         return group_id in self.threads
@@ -38,263 +146,210 @@ class ConversationManager:
         """Obtiene el thread_id asociado a un group_id si existe."""
         return self.threads.get(group_id)
 
-    async def get_thread_lock(self, group_id: int) -> asyncio.Lock:
-        """Obtiene o crea un lock para el group_id específico."""
-        if group_id not in self._thread_locks:
-            self._thread_locks[group_id] = asyncio.Lock()
-        return self._thread_locks[group_id]
-
     async def set_thread_id(self, group_id: int, thread_id: str = None) -> Optional[str]:
         """
         Asocia un thread_id a un group_id en la memoria del proyecto.
         Devuelve el thread_id resultante.
         """
-        # Adquirir lock específico para este group_id
-        lock = await self.get_thread_lock(group_id)
-        async with lock:
-            # Verificar de nuevo si ya existe un thread_id (podría haberse creado mientras esperábamos el lock)
-            existing_thread_id = self.get_thread_id(group_id)
-            if existing_thread_id:
-                print(f"[DEBUG] Se encontró thread_id existente mientras esperaba lock: {existing_thread_id}")
-                return existing_thread_id
-            
-            if thread_id and isinstance(thread_id, str):  # Asegurar que el thread_id es válido antes de asignarlo
-                self.threads[group_id] = thread_id
-                print(f"[DEBUG] Se asoció thread_id: {thread_id} al group_id: {group_id}")
-                
-                # Sincronizar con los handlers
-                for bot_name, bot in self.all_bots.items():
-                    bot.assistant_handler.threads[group_id] = thread_id
+        # Camino rápido: si el grupo ya tiene thread no hay nada que hacer
+        existing_thread_id = self.threads.get(group_id)
+        if existing_thread_id:
+            return existing_thread_id
+
+        if thread_id and isinstance(thread_id, str):  # Asegurar que el thread_id es válido antes de asignarlo
+            self.threads[group_id] = thread_id
+            logger.debug("Se asoció thread_id: %s al group_id: %s", thread_id, group_id)
+            return thread_id
+
+        # Si ya se está creando el thread de este grupo, esperar a ese mismo resultado
+        pending = self._thread_creation.get(group_id)
+        if pending is not None:
+            logger.debug("Esperando a la creación en curso del thread para group_id: %s", group_id)
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._thread_creation[group_id] = future
+        new_thread_id = None
+        try:
+            new_thread_id = await self._create_thread(group_id)
+            return new_thread_id
+        finally:
+            del self._thread_creation[group_id]
+            future.set_result(new_thread_id)
+
+    async def _create_thread(self, group_id: int) -> Optional[str]:
+        """Crea un thread nuevo en OpenAI para el grupo. Devuelve su id o None si falla."""
+        logger.debug("No se encontró un thread_id para group_id: %s, creando uno nuevo.", group_id)
+        try:
+            if self._first_bot is None:
+                logger.error("No hay bots registrados para crear el thread.")
+                return None
+            thread = await self._first_bot.assistant_handler.client.beta.threads.create()
+            if thread and hasattr(thread, 'id') and thread.id:
+                new_thread_id = thread.id
+                self.threads[group_id] = new_thread_id
                 
-                return thread_id
+                logger.debug("Nuevo thread_id creado: %s para group_id: %s", new_thread_id, group_id)
+                return new_thread_id
             else:
-                print(f"[DEBUG] No se encontró un thread_id para group_id: {group_id}, creando uno nuevo.")
-                try:
-                    next_bot = next(iter(self.all_bots.values()))
-                    thread = next_bot.assistant_handler.client.beta.threads.create()
-                    if thread and hasattr(thread, 'id') and thread.id:
-                        new_thread_id = thread.id
-                        self.threads[group_id] = new_thread_id
-                        
-                        # Sincronizar con los handlers
-                        for bot_name, bot in self.all_bots.items():
-                            bot.assistant_handler.threads[group_id] = new_thread_id
-                        
-                        print(f"[DEBUG] Nuevo thread_id creado: {new_thread_id} para group_id: {group_id}")
-                        return new_thread_id
-                    else:
-                        print(f"[ERROR] No se pudo crear un thread válido para group_id: {group_id}")
-                        return None
-                except Exception as e:
-                    print(f"[ERROR] Error al crear thread: {e}")
-                    return None
+                logger.error("No se pudo crear un thread válido para group_id: %s", group_id)
+                return None
+        except Exception as e:
+            logger.error("Error al crear thread: %s", e)
+            return None
 
     def get_next_bot(self) -> Optional[str]:
         """Obtiene el siguiente bot disponible en la rotación para responder."""
-        if not self.all_bots:
-            return None
-        return next(iter(self.all_bots.keys()))
+        return self._first_bot_name
 
     def prepare_text_for_html(self, text):
         """
         Prepara el texto para ser enviado con formato HTML a Telegram.
         Enfoque optimizado para formatear correctamente títulos y listas.
         """
-        # Paso 1: Eliminar los marcadores ### de encabezados
-        text = re.sub(r'###\s+', '', text)
+        # Los fragmentos sin ningún marcador de formato se devuelven tal cual sin pasar por los regex
+        if not any(trigger in text for trigger in _HTML_FORMAT_TRIGGERS):
+            return text
+        
+        # Paso 1: Eliminar los marcadores ### de encabezados y los espacios antes de los dos puntos
+        text = _RE_H3_OR_COLON.sub(_strip_header_or_colon, text)
         
         # Paso 2: Convertir **texto** a <b>texto</b> (negrita)
         # Primero capturamos los casos especiales con asteriscos y espacios
-        text = re.sub(r'\*\*\s+([^*]+)\s+\*\*', r'<b>\1</b>', text)
+        text = _RE_BOLD_SP.sub(r'<b>\1</b>', text)
         # Luego los casos normales
-        text = re.sub(r'\*\*([^*]+)\*\*', r'<b>\1</b>', text)
-        
-        # Paso 3: Eliminar espacios antes de los dos puntos
-        text = re.sub(r'\s+:', r':', text)
-        
-        # Paso 4: Formatear listas con viñetas
-        # Primero convertimos listas con • que ya existan
-        text = re.sub(r'•\s+', '• ', text)
-        # Convertir guiones en viñetas
-        text = re.sub(r'\n\s*-\s+', '\n• ', text)
+        text = _RE_BOLD.sub(r'<b>\1</b>', text)
         
-        # Paso 5: Manejar elementos numerados
-        text = re.sub(r'(\d+)\.\s+<b>([^<]+)</b>:', r'\1. <b>\2</b>:', text)
+        # Paso 3: Formatear listas con viñetas
+        # Normalizamos el espaciado de las viñetas • y convertimos guiones en viñetas
+        text = _normalize_bullets(text)
         
-        # Paso 6: Aplicar espaciado consistente después de las viñetas
-        text = re.sub(r'•\s+', '• ', text)
+        # Paso 4: Manejar elementos numerados
+        text = _RE_NUMBERED.sub(r'\1. <b>\2</b>:', text)
         
-        # Paso 7: Asegurar que no haya etiquetas HTML escapadas
-        text = text.replace('&lt;b&gt;', '<b>').replace('&lt;/b&gt;', '</b>')
-        text = text.replace('&lt;i&gt;', '<i>').replace('&lt;/i&gt;', '</i>')
+        # Paso 5: Asegurar que no haya etiquetas HTML escapadas
+        text = _RE_ESCAPED_TAG.sub(r'<\1>', text)
         
         return text
     
     def save_user_info(self, group_id: int, name: str):
         """Guarda información del usuario para personalizar respuestas."""
-        if group_id not in self.user_data:
-            self.user_data[group_id] = {}
-        self.user_data[group_id]['name'] = name
-        print(f"[DEBUG] Guardada información del usuario {name} para group_id: {group_id}")
+        data = self.user_data.get(group_id)
+        if data is None:
+            data = self.user_data[group_id] = {}
+        data['name'] = name
+        logger.debug("Guardada información del usuario %s para group_id: %s", name, group_id)
 
     def get_user_name(self, group_id: int) -> str:
         """Obtiene el nombre del usuario si está disponible."""
-        if group_id in self.user_data and 'name' in self.user_data[group_id]:
-            return self.user_data[group_id]['name']
+        data = self.user_data.get(group_id)
+        if data:
+            return data.get('name', "")
         return ""
 
-    async def handle_turn(self, group_id: int, message: str) -> None:
-        """Procesa un mensaje para el grupo correspondiente."""
-        print(f"[DEBUG] Procesando mensaje para group_id: {group_id}")
-
-        # Extraer información del usuario si está en el formato esperado
-        user_name_match = re.search(r'\[INFORMACIÓN DEL USUARIO: Nombre=([^\]]+)\]', message)
-        if user_name_match:
-            user_name = user_name_match.group(1)
+    async def _prepare(self, group_id: int, message: str, user_name: Optional[str] = None):
+        """
+        Guarda la información del usuario y resuelve el thread y el bot que responderá.
+        Devuelve (thread_id, bot, user_name, mensaje) o None si no se puede continuar.
+        """
+        if user_name:
             self.save_user_info(group_id, user_name)
-            # Eliminar la etiqueta de información del usuario del mensaje
-            message = re.sub(r'\[INFORMACIÓN DEL USUARIO: Nombre=[^\]]+\]\s*\n*', '', message)
-            print(f"[DEBUG] Mensaje procesado para {user_name}: {message}")
+        # Compatibilidad: etiqueta de usuario incrustada al inicio del mensaje (formato antiguo)
+        elif message.startswith(_USER_INFO_PREFIX):
+            end = message.find(']', len(_USER_INFO_PREFIX))
+            if end > len(_USER_INFO_PREFIX):
+                user_name = message[len(_USER_INFO_PREFIX):end]
+                self.save_user_info(group_id, user_name)
+                # Eliminar la etiqueta de información del usuario del mensaje
+                message = message[end + 1:].lstrip()
+                logger.debug("Mensaje procesado para %s: %s", user_name, message)
 
         # Obtener o crear thread_id de manera segura
-        thread_id = await self.set_thread_id(group_id, self.get_thread_id(group_id))
+        thread_id = self.threads.get(group_id) or await self.set_thread_id(group_id)
         if not thread_id:
-            print(f"[ERROR] No se pudo obtener o crear un thread_id válido para group_id: {group_id}")
-            return
+            logger.error("No se pudo obtener o crear un thread_id válido para group_id: %s", group_id)
+            return None
 
-        print(f"[DEBUG] Usando thread_id: {thread_id} para group_id: {group_id}")
+        logger.debug("Usando thread_id: %s para group_id: %s", thread_id, group_id)
 
         next_bot_name = self.get_next_bot()
         if not next_bot_name:
-            print("[ERROR] No hay bots disponibles para responder.")
-            return
-
-        next_bot = self.all_bots[next_bot_name]
-        user_name = self.get_user_name(group_id)
+            logger.error("No hay bots disponibles para responder.")
+            return None
 
-        # Forzar la actualización del thread_id en el handler
-        if group_id not in next_bot.assistant_handler.threads or next_bot.assistant_handler.threads.get(group_id) != thread_id:
-            print(f"[DEBUG] Sincronizando thread_id con el handler: {thread_id}")
-            next_bot.assistant_handler.threads[group_id] = thread_id
+        return thread_id, self._first_bot, self.get_user_name(group_id), message
 
-        async def send_to_telegram(chunk):
-            """Envía la respuesta del bot al usuario/grupo correcto con formato HTML."""
+    async def _send_html(self, bot, chat_id: int, user_name: str, chunk: str) -> None:
+        """Envía la respuesta del bot al usuario/grupo con formato HTML, con Markdown y texto plano como respaldo."""
+        try:
+            # Personalizar la respuesta con el nombre del usuario si está disponible
+            if user_name:
+                # Añadir personalización inteligente - solo si la respuesta parece apropiada
+                if chunk[:16].lower().startswith(_GREETING_PREFIXES):
+                    chunk = chunk.replace('Hola', f'Hola {user_name}', 1)
+                elif '!' in chunk and 'espero' in chunk.lower():
+                    chunk = chunk.replace('!', f", {user_name}!", 1)
+            
+            # Convertir texto a formato HTML para mejor compatibilidad
+            html_text = self.prepare_text_for_html(chunk)
+            await bot.application.bot.send_message(
+                chat_id=chat_id, 
+                text=html_text,
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as e:
+            # Si falla con HTML, intentar con Markdown
+            logger.warning("Error enviando mensaje con HTML: %s", e)
             try:
-                # Personalizar la respuesta con el nombre del usuario si está disponible
-                if user_name:
-                    # Añadir personalización inteligente - solo si la respuesta parece apropiada
-                    if re.search(r'^(hola|buenos días|buenas tardes|buenas noches)', chunk.lower()):
-                        chunk = chunk.replace('Hola', f'Hola {user_name}', 1)
-                    elif 'espero' in chunk.lower() and '!' in chunk:
-                        chunk = chunk.replace('!', f", {user_name}!", 1)
-                
-                # Convertir texto a formato HTML para mejor compatibilidad
-                html_text = self.prepare_text_for_html(chunk)
-                await next_bot.application.bot.send_message(
-                    chat_id=group_id, 
-                    text=html_text,
-                    parse_mode=ParseMode.HTML
+                await bot.application.bot.send_message(
+                    chat_id=chat_id, 
+                    text=chunk,
+                    parse_mode=ParseMode.MARKDOWN
                 )
             except Exception as e:
-                # Si falla con HTML, intentar con Markdown
-                print(f"[WARN] Error enviando mensaje con HTML: {e}")
+                # Si falla con Markdown, intentar sin formato
+                logger.warning("Error enviando mensaje con Markdown: %s", e)
                 try:
-                    await next_bot.application.bot.send_message(
-                        chat_id=group_id, 
-                        text=chunk,
-                        parse_mode=ParseMode.MARKDOWN
+                    await bot.application.bot.send_message(
+                        chat_id=chat_id, 
+                        text=chunk
                     )
                 except Exception as e:
-                    # Si falla con Markdown, intentar sin formato
-                    print(f"[WARN] Error enviando mensaje con Markdown: {e}")
-                    try:
-                        await next_bot.application.bot.send_message(
-                            chat_id=group_id, 
-                            text=chunk
-                        )
-                    except Exception as e:
-                        print(f"[ERROR] Error enviando mensaje a Telegram: {e}")
+                    logger.error("Error enviando mensaje a Telegram: %s", e)
+
+    async def handle_turn(self, group_id: int, message: str, user_name: Optional[str] = None) -> None:
+        """Procesa un mensaje para el grupo correspondiente."""
+        logger.debug("Procesando mensaje para group_id: %s", group_id)
+
+        prepared = await self._prepare(group_id, message, user_name)
+        if prepared is None:
+            return
+        thread_id, next_bot, user_name, message = prepared
 
+        send_to_telegram = functools.partial(self._send_html, next_bot, group_id, user_name)
         try:
             await next_bot.assistant_handler.stream_response(group_id, message, send_to_telegram)
         except Exception as e:
-            print(f"[ERROR] Error durante el procesamiento del mensaje: {e}")
+            logger.error("Error durante el procesamiento del mensaje: %s", e)
     
-    async def handle_image(self, group_id: int, message: str, image_base64: str, image_path: str) -> None:
+    async def handle_image(self, group_id: int, message: str, image_base64: str, image_path: str,
+                           user_name: Optional[str] = None) -> None:
         """Procesa un mensaje que contiene una imagen."""
-        print(f"[DEBUG] Procesando imagen para group_id: {group_id}")
-        
-        # Extraer información del usuario
-        user_name_match = re.search(r'\[INFORMACIÓN DEL USUARIO: Nombre=([^\]]+)\]', message)
-        if user_name_match:
-            user_name = user_name_match.group(1)
-            self.save_user_info(group_id, user_name)
-            # Eliminar la etiqueta de información del usuario del mensaje
-            message = re.sub(r'\[INFORMACIÓN DEL USUARIO: Nombre=[^\]]+\]\s*\n*', '', message)
-        
-        # Obtener o crear thread_id de manera segura
-        thread_id = await self.set_thread_id(group_id, self.get_thread_id(group_id))
-        if not thread_id:
-            print(f"[ERROR] No se pudo obtener o crear un thread_id válido para group_id: {group_id}")
-            return
+        logger.debug("Procesando imagen para group_id: %s", group_id)
         
-        print(f"[DEBUG] Usando thread_id: {thread_id} para group_id: {group_id}")
-            
-        next_bot_name = self.get_next_bot()
-        if not next_bot_name:
-            print("[ERROR] No hay bots disponibles para responder.")
+        prepared = await self._prepare(group_id, message, user_name)
+        if prepared is None:
             return
-            
-        next_bot = self.all_bots[next_bot_name]
-        user_name = self.get_user_name(group_id)
-        
-        # Forzar la actualización del thread_id en el handler
-        if group_id not in next_bot.assistant_handler.threads or next_bot.assistant_handler.threads.get(group_id) != thread_id:
-            print(f"[DEBUG] Sincronizando thread_id con el handler: {thread_id}")
-            next_bot.assistant_handler.threads[group_id] = thread_id
-        
-        # Mismo callback de envío que en handle_turn
-        async def send_to_telegram(chunk):
-            try:
-                # Personalizar la respuesta con el nombre del usuario si está disponible
-                if user_name:
-                    # Añadir personalización inteligente - solo si la respuesta parece apropiada
-                    if re.search(r'^(hola|buenos días|buenas tardes|buenas noches)', chunk.lower()):
-                        chunk = chunk.replace('Hola', f'Hola {user_name}', 1)
-                    elif 'espero' in chunk.lower() and '!' in chunk:
-                        chunk = chunk.replace('!', f", {user_name}!", 1)
-                
-                # Convertir texto a formato HTML para mejor compatibilidad
-                html_text = self.prepare_text_for_html(chunk)
-                await next_bot.application.bot.send_message(
-                    chat_id=group_id, 
-                    text=html_text,
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception as e:
-                print(f"[WARN] Error enviando mensaje con HTML: {e}")
-                try:
-                    await next_bot.application.bot.send_message(
-                        chat_id=group_id, 
-                        text=chunk,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                except Exception as e:
-                    try:
-                        await next_bot.application.bot.send_message(
-                            chat_id=group_id, 
-                            text=chunk
-                        )
-                    except Exception as e:
-                        print(f"[ERROR] Error enviando mensaje a Telegram: {e}")
+        thread_id, next_bot, user_name, message = prepared
         
+        send_to_telegram = functools.partial(self._send_html, next_bot, group_id, user_name)
         try:
             # Llamar al método específico para imágenes en AssistantHandler
             await next_bot.assistant_handler.stream_image_response(
                 group_id, message, image_base64, image_path, send_to_telegram
             )
         except Exception as e:
-            print(f"[ERROR] Error durante el procesamiento de la imagen: {e}")
+            logger.error("Error durante el procesamiento de la imagen: %s", e)
             # Intentar enviar un mensaje de error
             try:
                 await next_bot.application.bot.send_message(
@@ -307,13 +362,9 @@ class ConversationManager:
             
     def end_conversation(self, group_id: int) -> bool:
         """Finaliza una conversación activa."""
+        self.active_conversation.pop(group_id, None)
         if group_id in self.threads:
-            thread_id = self.threads.pop(group_id)
-            
-            # Limpiar el thread_id de todos los handlers
-            for bot_name, bot in self.all_bots.items():
-                if group_id in bot.assistant_handler.threads:
-                    del bot.assistant_handler.threads[group_id]
+            self.threads.pop(group_id)
             
             # No eliminamos los datos del usuario para mantener la personalización
             return True
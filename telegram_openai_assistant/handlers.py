@@ -3,17 +3,26 @@ from telegram import Update
 from telegram.constants import ParseMode
 import os
 import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Carpeta para imágenes temporales, creada una sola vez al importar el módulo
+_TEMP_IMAGE_FOLDER = os.path.join("data", "temp_images")
+os.makedirs(_TEMP_IMAGE_FOLDER, exist_ok=True)
 
 
 class BotHandlers:
+    __slots__ = ('assistant_id', 'telegram_id', 'bot_name', 'manager', 'temp_image_folder', '_mention')
+
     def __init__(self, bot_name: str, assistant_id: str, telegram_id: str, manager):
         self.assistant_id = assistant_id
         self.telegram_id = telegram_id
         self.bot_name = bot_name
         self.manager = manager
-        self.temp_image_folder = os.path.join("data", "temp_images")
-        # Crear carpeta para imágenes temporales si no existe
-        os.makedirs(self.temp_image_folder, exist_ok=True)
+        self._mention: Optional[str] = None  # '@' + username del bot, se fija en el primer mensaje de grupo
+        self.temp_image_folder = _TEMP_IMAGE_FOLDER
 
     async def start(self, update: Update, context: CallbackContext) -> None:
         """Envía un mensaje de bienvenida e inicia preguntas para conocer al usuario."""
@@ -86,7 +95,7 @@ class BotHandlers:
         
         # Descargar la foto
         await photo_file.download_to_drive(file_path)
-        print(f"[DEBUG] Imagen descargada en: {file_path}")
+        logger.debug("Imagen descargada en: %s", file_path)
         
         return file_path
 
@@ -117,21 +126,17 @@ class BotHandlers:
             # Obtener la descripción o pregunta del usuario (caption)
             caption = update.message.caption or "Analiza esta imagen y describe lo que ves."
             
-            # Preparar contexto para el asistente con información del usuario
-            user_context = f"[INFORMACIÓN DEL USUARIO: Nombre={user_name}]\n\n"
-            enhanced_message = user_context + caption
-            
             # Enviar mensaje de que estamos procesando pero sin la codificación
-            print(f"[DEBUG] Procesando imagen: {image_path}")
+            logger.debug("Procesando imagen: %s", image_path)
             
             # Enviar la imagen y el mensaje al asistente - sin pre-codificar la imagen
-            await self.manager.handle_image(chat_id, enhanced_message, None, image_path)
+            await self.manager.handle_image(chat_id, caption, None, image_path, user_name=user_name)
             
             # Eliminar mensaje de procesamiento
             await context.bot.delete_message(chat_id=chat_id, message_id=processing_message.message_id)
             
         except Exception as e:
-            print(f"[ERROR] Error procesando foto: {e}")
+            logger.error("Error procesando foto: %s", e)
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=processing_message.message_id,
@@ -145,7 +150,7 @@ class BotHandlers:
             return  # No message to process
 
         if update.message.from_user.is_bot:
-            print("El mensaje proviene de un bot, ignorando...")
+            logger.debug("El mensaje proviene de un bot, ignorando...")
             return  # Ignora mensajes enviados por bots
         
         # Obtener y guardar el nombre del usuario
@@ -157,11 +162,7 @@ class BotHandlers:
         chat_type = update.effective_chat.type
         group_id = update.effective_chat.id
         message_text = update.message.text
-        print(f"Mensaje recibido de {update.message.from_user.username} ({user_name}): {message_text}")
-
-        # Preparar contexto para el asistente con información del usuario
-        user_context = f"[INFORMACIÓN DEL USUARIO: Nombre={user_name}]\n\n"
-        enhanced_message = user_context + message_text
+        logger.debug("Mensaje recibido de %s (%s): %s", update.message.from_user.username, user_name, message_text)
 
         if chat_type == "private":
             # No verificar menciones en chats privados
@@ -172,20 +173,23 @@ class BotHandlers:
                         text=f"Estoy procesando tu solicitud {user_name}, un momento por favor...",
                         parse_mode=ParseMode.HTML
                     )
-            await self.manager.handle_turn(group_id, enhanced_message)
+            await self.manager.handle_turn(group_id, message_text, user_name=user_name)
         else:
             # Solo procesar mensajes en grupos si el bot está mencionado
             if update.message.entities:
+                if self._mention is None:
+                    self._mention = '@' + context.bot.username
                 for entity in update.message.entities:
-                    if entity.type == 'mention' and '@' + context.bot.username in message_text[entity.offset:entity.offset + entity.length]:
+                    if entity.type == 'mention' and update.message.parse_entity(entity) == self._mention:
                         if not self.manager.is_active(group_id):
-                            if self.manager.active_conversation(group_id, self.bot_name):
+                            if self.manager.start_conversation(group_id, self.bot_name):
                                 await context.bot.send_message(
                                     chat_id=group_id,
                                     text=f"Conversación iniciada por {self.bot_name} en el grupo {group_id}. Usa /end para terminar.",
                                     parse_mode=ParseMode.HTML
                                 )
-                        await self.manager.handle_turn(group_id, enhanced_message)
+                        await self.manager.handle_turn(group_id, message_text, user_name=user_name)
+                        break
 
     async def end_conversation(self, update: Update, context: CallbackContext) -> None:
         """Ends the active conversation."""
@@ -28,6 +28,6 @@ while True:
     time.sleep(1)
 
 
-messages = client.beta.threads.messages.list(thread_id=thread.id)
+messages = client.beta.threads.messages.list(thread_id=thread.id, order="desc", limit=1)
 
 print(messages.dict()["data"][0]["content"][0]["text"]["value"])